@@ -1,16 +1,23 @@
-import shutil
 import pandas as pd
+from collections        import deque
 from typing             import Optional
 from pathlib            import Path
-from primary_function   import merge_csvs, treatment, find_renob
-from storage            import load_config, log_merge_file, backup, count_lines, resource_path
-from PySide6.QtCore     import QPoint, Qt, QSize, QEvent, QPropertyAnimation, QThread, Signal
+from primary_function   import (
+    merge_csvs, treatment, find_renob, read_csv, touched_shards, export_aggregates, preview_merge,
+    restore_version, CSV_ENGINE
+)
+from storage            import (
+    load_config, log_merge_file, backup, master_rows, list_backups, describe_sources,
+    resource_path, file_lock, io_lock
+)
+from PySide6.QtCore     import QPoint, Qt, QSize, QEvent, QPropertyAnimation, QThread, QTimer, Signal
 from PySide6.QtGui      import QIcon, QCursor
 from PySide6.QtWidgets  import (
     QMainWindow,    QPushButton,    QVBoxLayout,    QHBoxLayout,
     QWidget,        QProgressBar,   QFileDialog,    QMessageBox, 
     QLineEdit,      QRadioButton,   QButtonGroup,  
-    QGridLayout,    QToolButton,    QTextEdit,      QLabel
+    QGridLayout,    QToolButton,    QPlainTextEdit, QLabel,
+    QInputDialog
 )
 
 
@@ -23,6 +30,42 @@ BACKUP_DIR      .mkdir(exist_ok=True)
 DATA_DIR        = cfg["data_dir"]
 DATA_DIR        .mkdir(exist_ok=True)
 
+# atualização da interface: logs e progresso entram em lote a cada frame
+FRAME_MS        = 50        # ~20 atualizações por segundo
+LOG_MAX_LINES   = 5000      # linhas mantidas no painel Detalhes
+DEBOUNCE_MS     = 300       # pausa na digitação antes de validar os caminhos
+
+
+class LogView(QPlainTextEdit):
+    """
+    Painel de log com número máximo de linhas. append() só enfileira a mensagem;
+    as linhas pendentes entram de uma vez a cada FRAME_MS, em vez de uma por sinal.
+    """
+    def __init__(self, max_lines: int = LOG_MAX_LINES):
+        super().__init__()
+        self.setReadOnly(True)
+        self.setMaximumBlockCount(max_lines)            # descarta as linhas mais antigas
+        self._pending = deque(maxlen=max_lines)         # mais que isso nem chegaria a aparecer
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(FRAME_MS)
+        self._timer.timeout.connect(self.flush)
+
+    def append(self, text: str):
+        self._pending.append(text)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        if self._pending:
+            self.appendPlainText("\n".join(self._pending))
+            self._pending.clear()
+
+    def clear(self):
+        self._pending.clear()
+        super().clear()
+
 
 class Worker(QThread):
     # sinais: emite um int (0–100) para progresso, e notifica fim de processamento
@@ -40,20 +83,40 @@ class Worker(QThread):
         self.total          = 0
         self.added          = 0
         self.total_lines    = 0
+        self.touched        = set()     # shards (ANO_UF) dos agregados do site afetados
+        self.backup_version = None      # versão do catálogo gerada no início do job
+        self.error          = None      # exceção que interrompeu o job, se houver
+        self.restored       = False     # True se o cancelamento restaurou o backup
 
     def run(self):
+        # segura o lock do master durante todo o job (backup + merges); se outra
+        # instância do app (ou um script) estiver usando o mesmo master, espera
+        try:
+            with file_lock(
+                self.master,
+                on_wait=lambda: self.log.emit("⏳ Master em uso por outra execução, aguardando...")
+            ):
+                self.process()
+        except Exception as e:
+            self.error = e
+            self.log.emit(f"❌ Erro: {e}")
+        finally:
+            # emite finished com flag se cancelou, mesmo em caso de erro, para a
+            # janela liberar o master e seguir com a fila
+            self.finished.emit(self.cancel_requested)
+
+    def process(self):
         # 1) Inicialização → 10%
         self.total = len(self.paths)
-        if self.master.exists():
-            self.total_lines = count_lines(self.master)
-        else:
-            self.total_lines = 0
+        self.total_lines = master_rows(self.master)
+        self.log.emit(f"⚙️ Leitor de CSV: {CSV_ENGINE}")
         self.progresso.emit(10)
 
         # 2) Backup → 20%
         if self.master.exists() and not self.cancel_requested:
             self.log.emit("💾 Fazendo backup...")
-            backup(self.master, self.backup_dir)
+            entry = backup(self.master, self.backup_dir, source=describe_sources(self.paths))
+            self.backup_version = entry["version"]
         self.progresso.emit(20)
 
         # 3) Processa cada CSV → de 20% a 90%
@@ -77,14 +140,100 @@ class Worker(QThread):
                 total_after  = result["total_after"]
             )
             self.added += result["added_count"]
+            self.touched |= touched_shards(result["added_rows"], self.master)
         self.total_lines += self.added
         # 4) Final → 100%
         if not self.cancel_requested:
             self.progresso.emit(100)
+        elif self.backup_version:
+            # cancelado: volta o master (e o .meta/índice de dedup) para o backup do início do job
+            self.log.emit("↩️ Restaurando o backup...")
+            restore_version(self.master, self.backup_dir, self.backup_version)
+            self.restored = True
+
+
+class PathCheckWorker(QThread):
+    # valida os caminhos digitados (acesso a disco) fora da thread da interface
+    finished = Signal(str, list, list)  # texto validado, caminhos válidos, caminhos inválidos
+
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+
+    def run(self):
+        # 1) divide e limpa
+        candidates = [p.strip() for p in self.text.split(';') if p.strip()]
+        # 2) valida existência e extensão
+        invalid_paths = []
+        valid_paths = []
+        for p in candidates:
+            if Path(p).is_file() and p.lower().endswith('.csv'):
+                valid_paths.append(p)
+            else:
+                invalid_paths.append(p)
+        self.finished.emit(self.text, valid_paths, invalid_paths)
+
+
+class BackupTaskWorker(QThread):
+    # lista/restaura backups (lê e calcula sha256 de CSVs inteiros) sem travar a interface
+    finished = Signal(object)   # retorno de `task`, ou a exceção
+
+    def __init__(self, task):
+        super().__init__()
+        self.task = task
+
+    def run(self):
+        try:
+            result = self.task()
+        except Exception as e:
+            result = e
+        self.finished.emit(result)
+
+
+class ExportWorker(QThread):
+    # exporta o master e os agregados para o site sem travar a interface
+    finished = Signal(object)   # nº de arquivos de agregados escritos, ou a exceção
+
+    def __init__(self, master, op_path, touched, added):
+        super().__init__()
+        self.master  = master
+        self.op_path = op_path
+        self.touched = touched
+        self.added   = added
+
+    def run(self):
+        try:
+            with io_lock(self.master):
+                df_master = read_csv(self.master)
+            df_master.to_csv(str(self.op_path), index=False)
+
+            # exports do Sisvan e do Regional não gravam os agregados ao mesmo tempo
+            with file_lock(DATA_DIR / "aggregates"):
+                result = export_aggregates(
+                    self.op_path.parent / "aggregates",
+                    touched = self.touched,
+                    added   = self.added
+                )
+        except Exception as e:
+            result = e
+        self.finished.emit(result)
+
 
-        # 5) emite finished com flag se cancelou
-        self.finished.emit(self.cancel_requested)
+class PreviewWorker(QThread):
+    # calcula a prévia do merge (somente leitura) sem travar a interface
+    finished = Signal(object)   # lista de resultados de preview_merge, ou a exceção
+
+    def __init__(self, paths, master):
+        super().__init__()
+        self.paths  = paths
+        self.master = master
 
+    def run(self):
+        try:
+            result = preview_merge(self.paths, self.master)
+        except Exception as e:
+            result = e
+        self.finished.emit(result)
 
 
 class MainWindow(QMainWindow):
@@ -96,7 +245,23 @@ class MainWindow(QMainWindow):
         self.last_backup: Path | None = None
         self.cancel_requested = False
 
-        self._progress_anim = None
+        self._progress_anims = {}           # barra -> animação em andamento
+        self._pending_progress = {}         # master -> último % recebido, aplicado no próximo frame
+
+        self.progress_timer = QTimer(self)
+        self.progress_timer .setSingleShot(True)
+        self.progress_timer .setInterval(FRAME_MS)
+        self.progress_timer .timeout.connect(self.flush_progress)
+
+        self.path_debounce  = QTimer(self)
+        self.path_debounce  .setSingleShot(True)
+        self.path_debounce  .setInterval(DEBOUNCE_MS)
+        self.path_debounce  .timeout.connect(self.validate_typed_paths)
+        self.path_check: PathCheckWorker | None = None
+
+        self.jobs       = {}                # master -> Worker em execução
+        self.exports    = {}                # master -> ExportWorker em execução
+        self.job_queue  = []                # (paths, master) esperando o master ficar livre
 
         self.setWindowTitle("Data Update")
         self.setWindowIcon(QIcon(resource_path("assets/app.png")))
@@ -115,6 +280,7 @@ class MainWindow(QMainWindow):
 
         self.rb_op2 = QRadioButton("Regional Database")
         self.rb_op2.setFixedHeight(30)
+        self.rb_op1.toggled.connect(self.update_job_buttons)
 
         group = QButtonGroup(self)
         group.setExclusive(True)
@@ -128,9 +294,12 @@ class MainWindow(QMainWindow):
             "Selecione o(s) arquivo(s) .csv ou digite o caminho aqui separados por ponto e vírgula (;)"
             )
         
-        self.progress       = QProgressBar()                              # barra de progresso
-        self.progress       .setFixedWidth(385)
-        self.progress       .hide()
+        self.progress_bars  = {}                                          # uma barra de progresso por master
+        for master in (SISVAN_FILE, REGIONAL_FILE):
+            bar = QProgressBar()
+            bar.setFixedWidth(190)
+            bar.hide()
+            self.progress_bars[master] = bar
         
         self.button_help    = QToolButton()                               # botão ajuda
         self.button_help    .setIcon(QIcon(resource_path("assets/help-icon.png")))
@@ -164,7 +333,13 @@ class MainWindow(QMainWindow):
         self.button_process .setFixedSize(self._button_w, self._button_h)
         self.button_process .setEnabled(False)
         self.button_process .clicked.connect(self.on_start_clicked)
-        self.worker: Worker | None = None
+
+        self.button_preview = QPushButton("Prévia")
+        self.button_preview .setFixedSize(self._button_w, self._button_h)
+        self.button_preview .setEnabled(False)
+        self.button_preview .clicked.connect(self.on_preview_clicked)
+        self.preview_worker: PreviewWorker | None = None
+        self.backup_task: BackupTaskWorker | None = None
 
         self.button_cancel  = QPushButton("Cancelar")
         self.button_cancel  .setFixedSize(self._button_w, self._button_h)
@@ -173,7 +348,7 @@ class MainWindow(QMainWindow):
 
         self.button_restore = QPushButton("Restaurar")
         self.button_restore .setFixedSize(self._button_w, self._button_h)
-        self.button_restore .clicked.connect(self.restore_last_backup)
+        self.button_restore .clicked.connect(self.restore_from_backup)
 
         self.details_button = QToolButton()
         self.details_button .setFixedSize(self._button_w, self._button_h)
@@ -185,14 +360,14 @@ class MainWindow(QMainWindow):
         self.details_button .toggled.connect(self.on_toggle_details)
         self.details_button .setToolButtonStyle(Qt.ToolButtonStyle.ToolButtonTextBesideIcon)
 
-        self.details_text   = QTextEdit()
-        self.details_text   .setReadOnly(True)
+        self.details_text   = LogView()
         self.details_text   .setStyleSheet("background-color: white;")
         self.details_text   .hide()
 
         for btn in (
             self.details_button,
             self.button_restore,
+            self.button_preview,
             self.button_process,
             self.button_cancel,
             self.button_select
@@ -210,7 +385,8 @@ class MainWindow(QMainWindow):
         top_layout.addWidget(self.rb_op1)
         top_layout.addWidget(self.rb_op2)
         top_layout.addStretch()
-        top_layout.addWidget(self.progress)
+        for bar in self.progress_bars.values():
+            top_layout.addWidget(bar)
         top_layout.addStretch()
         top_layout.addWidget(self.button_help)                               
 
@@ -228,6 +404,7 @@ class MainWindow(QMainWindow):
         bottom_layout = QHBoxLayout()
         bottom_layout.addWidget(self.button_restore)
         bottom_layout.addStretch()
+        bottom_layout.addWidget(self.button_preview)
         bottom_layout.addWidget(self.button_process)
         bottom_layout.addWidget(self.button_cancel)
 
@@ -240,7 +417,8 @@ class MainWindow(QMainWindow):
         container = QWidget()                                             # container para encapsular tudo
         container.setLayout(layout)                                       # traz o layout pra dentro
         self.setCentralWidget(container)                                  # define como central na janela
-        self.progress.setStyleSheet(
+        for bar in self.progress_bars.values():
+            bar.setStyleSheet(
             """
                 QProgressBar {
                     border: 1px solid #AAA;
@@ -257,7 +435,7 @@ class MainWindow(QMainWindow):
                     background-color: #74dba2;
                 }
             """
-        )
+            )
 
     
     # SISVAN OU REGIONAL?
@@ -279,10 +457,11 @@ class MainWindow(QMainWindow):
                     "COMO USAR:\n"
                     "1. Selecione qual database deseja atualizar (Sisvan ou Regional).\n"
                     "2. Clique em 'Browser' e selecione CSV(s) ou escreva o(s) caminho(s) na caixa de texto.\n"
-                    "3. Clique em 'Iniciar' para atualizar a database.\n"
-                    "4. 'Detalhes' mostra em qual parte do processo está.\n"
-                    "5. Para cancelar durante o processo, use 'Cancelar'.\n"
-                    "6. Caso precise restaurar para a última versão, use 'Restaurar'.\n\n"
+                    "3. (Opcional) 'Prévia' mostra quantas linhas cada arquivo adicionaria, sem gravar nada.\n"
+                    "4. Clique em 'Iniciar' para atualizar a database.\n"
+                    "5. 'Detalhes' mostra em qual parte do processo está.\n"
+                    "6. Para cancelar durante o processo, use 'Cancelar'.\n"
+                    "7. Caso precise voltar a uma versão anterior, use 'Restaurar' e escolha o backup.\n\n"
                     "COMO FUNCIONA?\n"
                     "1. Lê os arquivos\n"
                     "2. Os comparam com a database atual\n"
@@ -330,20 +509,52 @@ class MainWindow(QMainWindow):
             self.details_button.setArrowType(Qt.ArrowType.RightArrow)
             self.setFixedSize(self._base_w, self._base_h)
 
-    def smooth_set_value(self, new_value: int, duration: int = 300):
+    def job_name(self, master: Path) -> str:
+        return "Sisvan" if master == SISVAN_FILE else "Regional"
+
+    def smooth_set_value(self, bar: QProgressBar, new_value: int, duration: int = 300):
         """
-        Anima a barra de progresso de self.progress.value() até new_value em `duration` ms.
+        Anima a barra de progresso de bar.value() até new_value em `duration` ms.
         """
+        # interrompe a animação anterior da mesma barra
+        old = self._progress_anims.get(bar)
+        if old is not None:
+            old.stop()
+
         # cria o objeto de animação
-        anim = QPropertyAnimation(self.progress, b"value", self)
+        anim = QPropertyAnimation(bar, b"value", self)
         anim.setDuration(duration)
-        anim.setStartValue(self.progress.value())
+        anim.setStartValue(bar.value())
         anim.setEndValue(new_value)
         anim.start()
 
         # mantém referência viva
-        self._progress_anim = anim
+        self._progress_anims[bar] = anim
+
+    def queue_progress(self, master: Path, pct: int):
+        """
+        Guarda o progresso recebido do Worker; só o último valor de cada
+        master é aplicado, uma vez por frame (FRAME_MS).
+        """
+        self._pending_progress[master] = pct
+        if not self.progress_timer.isActive():
+            self.progress_timer.start()
+
+    def flush_progress(self):
+        pending, self._pending_progress = self._pending_progress, {}
+        for master, pct in pending.items():
+            bar = self.progress_bars[master]
+            self.smooth_set_value(bar, pct)
+            bar.setFormat(f"{self.job_name(master)} {pct}%")
         
+    def clear_details(self):
+        """
+        Limpa o painel Detalhes, a não ser que haja job rodando: o painel é
+        compartilhado e apagaria o log do job do outro master.
+        """
+        if not self.jobs:
+            self.details_text.clear()
+
     # abre a seleção de arquivo (.csv)
     def select_files(self):
 
@@ -356,37 +567,51 @@ class MainWindow(QMainWindow):
         self.paths  = paths
         db_name     = self.get_current_master().name
 
-        self.details_text.clear()
+        self.clear_details()
+        self.path_debounce.stop()
+        self.line_edit.blockSignals(True)                                     # caminhos do Browser já são válidos
         self.line_edit.setText("; ".join(paths))                              # escreve os caminhos na caixa de texto
+        self.line_edit.blockSignals(False)
         self.details_text.append(f"- {len(paths)} arquivo(s) selecionado(s) para {db_name}:")
         for p in paths:
             self.details_text.append(f"  • {p}")
-        self.progress.setValue(0)                                             # Atualiza a barra de progresso em 10%
+        self.progress_bars[self.get_current_master()].setValue(0)             # zera a barra de progresso
         self.button_process.setEnabled(True)
+        self.button_preview.setEnabled(True)
+        self.on_preview_clicked()                                             # já mostra a prévia do merge
     
     def on_line_edit_changed(self, text: str):
-        # 1) divide e limpa
-        candidates = [p.strip() for p in text.split(';') if p.strip()]
-        # 2) valida existência e extensão
-        invalid_paths = []
-        valid_paths = []
-        for p in candidates:
-            if Path(p).is_file() and p.lower().endswith('.csv'):
-                valid_paths.append(p)
-            else:
-                invalid_paths.append(p)
-        
+        # a validação (acesso a disco) só roda quando a digitação pausa por DEBOUNCE_MS
+        self.button_process.setEnabled(False)
+        self.button_preview.setEnabled(False)
+        self.path_debounce.start()
+
+    def validate_typed_paths(self):
+        """
+        Valida os caminhos digitados em segundo plano (PathCheckWorker).
+        Se já houver uma validação rodando, o resultado dela revalida o texto novo.
+        """
+        if self.path_check and self.path_check.isRunning():
+            return
+        self.path_check = PathCheckWorker(self.line_edit.text())
+        self.path_check.finished.connect(self.on_paths_checked)
+        self.path_check.start()
+
+    def on_paths_checked(self, text: str, valid_paths: list, invalid_paths: list):
+        self.path_check.wait()                      # o sinal sai do fim do run(); espera a thread encerrar
+        if text != self.line_edit.text():           # usuário continuou digitando: resultado já é velho
+            self.validate_typed_paths()
+            return
+
         # 3) atualiza a lista de arquivos
         self.paths = valid_paths
 
         # 4) controla o botão Iniciar
-        has_any = bool(valid_paths)
-        self.button_process.setEnabled(has_any)
+        self.update_job_buttons()
 
-        self.details_text.clear()
+        self.clear_details()
         if valid_paths:
             self.details_text.append(f"- {len(valid_paths)} arquivo(s) detectado(s):")
-            self.button_process.setEnabled(True)
             for p in valid_paths:
                 self.details_text.append(f"  • {p}")
         if invalid_paths:
@@ -395,65 +620,148 @@ class MainWindow(QMainWindow):
                 self.details_text.append(f" ❌ {p}")
         if not valid_paths and not invalid_paths:
             self.details_text.append("Nenhum caminho informado.")
+
+    def on_preview_clicked(self):
+        """
+        Calcula, em segundo plano, quantas linhas cada arquivo adicionaria ao master.
+        Não grava master, backup nem log.
+        """
+        if not self.paths or (self.preview_worker and self.preview_worker.isRunning()):
+            return
+        master = self.get_current_master()
+        self.preview_worker = PreviewWorker(list(self.paths), master)
+
+        self.button_preview.setEnabled(False)
+        self.button_process.setEnabled(False)
+        self.details_text.append(f"🔎 Calculando prévia para {master.name} (nada será gravado)...")
+
+        self.preview_worker.finished.connect(self.on_preview_finished)
+        self.preview_worker.start()
+
+    def on_preview_finished(self, result):
+        """
+        Mostra no painel Detalhes o resumo da prévia, arquivo por arquivo.
+        """
+        self.preview_worker.wait()                  # o sinal sai do fim do run(); espera a thread encerrar
+        self.update_job_buttons()
+
+        if isinstance(result, Exception):
+            self.details_text.append(f"❌ Falha ao calcular a prévia: {result}")
+            return
+
+        total_new = 0
+        for r in result:
+            total_new += r["new_count"]
+            self.details_text.append(
+                f"  • {Path(r['input_file']).name}: {r['new_count']} nova(s), "
+                f"{r['duplicate_count']} já existente(s), "
+                f"{r['batch_duplicate_count']} repetida(s) no lote"
+            )
+            if not r["sample"].empty:
+                self.details_text.append(r["sample"].to_string(index=False))
+        self.details_text.append(f"- Prévia: {total_new} linha(s) seria(m) adicionada(s).")
                 
       
 
+    def update_job_buttons(self):
+        """
+        Ajusta os botões ao master selecionado: Cancelar só com job rodando nele,
+        Restaurar só sem job. Iniciar continua ativo (entra na fila se ocupado).
+        """
+        busy       = self.get_current_master() in self.jobs
+        previewing = self.preview_worker is not None and self.preview_worker.isRunning()
+        restoring  = self.backup_task is not None and self.backup_task.isRunning()
+        self.button_cancel.setEnabled(busy)
+        self.button_restore.setEnabled(not busy and not restoring)
+        self.button_process.setEnabled(bool(self.paths) and not previewing)
+        self.button_preview.setEnabled(bool(self.paths) and not previewing)
+
     def on_start_clicked(self):
         if not self.paths:
             return
-        # cria e configura o worker
-        master      = self.get_current_master()
-        db_name     = master.stem
-        self.worker = Worker(self.paths, master, BACKUP_DIR)
+        master = self.get_current_master()
+        if master in self.jobs:
+            # mesmo master já em processamento: entra na fila
+            self.job_queue.append((list(self.paths), master))
+            self.details_text.append(f"- {master.stem} já está em processamento; job adicionado à fila.")
+            return
+        self.start_job(list(self.paths), master)
+
+    def start_job(self, paths: list, master: Path):
+        """
+        Cria e inicia um Worker para `master`. Jobs de masters diferentes
+        (Sisvan e Regional) rodam em paralelo, cada um com sua barra e seu log.
+        """
+        worker  = Worker(paths, master, BACKUP_DIR)
+        tag     = self.job_name(master)
+        bar     = self.progress_bars[master]
+        self.jobs[master] = worker
 
         # preenche UI antes de iniciar
-        self.progress.show()
-        self.button_process.setEnabled(False)
-        self.button_restore.setEnabled(False)
-        self.button_select.setEnabled(False)
-        self.rb_op1.setEnabled(False)
-        self.rb_op2.setEnabled(False)
-        self.button_cancel.setEnabled(True)
-        self.details_text.append(f'- Atualizando: {db_name}')
-        self.details_text.append(f"- Iniciando o processamento dos arquivos...")
+        bar.setValue(0)
+        bar.setFormat(f"{tag} 0%")
+        bar.show()
+        self.details_text.append(f'[{tag}] - Atualizando: {master.stem}')
+        self.details_text.append(f"[{tag}] - Iniciando o processamento dos arquivos...")
 
-        
         # conecta sinais
-        self.worker.progresso.connect(self.smooth_set_value)
-        self.worker.progresso.connect(lambda pct: self.progress.setFormat(f"{pct}%"))
-        self.worker.log.connect(self.details_text.append)
-        self.worker.finished.connect(self.on_worker_finished)
-        # opcional: permitir cancelar
-        self.worker.finished.connect(lambda _: None)  # só pra manter a referência
+        worker.progresso.connect(lambda pct, m=master: self.queue_progress(m, pct))
+        worker.log.connect(lambda msg, t=tag: self.details_text.append(f"[{t}] {msg}"))
+        worker.finished.connect(lambda canceled, w=worker: self.on_worker_finished(w, canceled))
         # starta o thread
-        self.worker.start()
+        worker.start()
+        self.update_job_buttons()
 
     def cancel_process(self):
         """
-        Marca a flag para interromper o loop de process_files.
-        A restauração acontece dentro de process_files após o break.
+        Cancela o job do master selecionado (e os que estavam na fila para ele).
         """
-        if self.worker:
-            self.worker.cancel_requested = True
+        master = self.get_current_master()
+        self.job_queue = [(p, m) for p, m in self.job_queue if m != master]
+        worker = self.jobs.get(master)
+        if worker:
+            worker.cancel_requested = True
         # opcional: você pode desabilitar o botão cancelar imediatamente
         self.button_cancel.setEnabled(False)
-        self.progress.hide()
+        self.progress_bars[master].hide()
     
-    def on_worker_finished(self, canceled: bool):
-        """
-        Recebe True se o usuário pediu cancelamento,
-        ou False se terminou normalmente.
-        """
-        worker = self.worker
-        assert worker is not None, "Worker deveria existir quando finished for chamado"
-        if canceled:
-            # restauramos o backup
-            if self.worker and self.worker.master.exists():
-                shutil.copy2(self.worker.master, self.worker.master)
-            self.details_text.append("🚫 Processo cancelado. Backup restaurado.")
+    def on_worker_finished(self, worker: Worker, canceled: bool):
+        """
+        Recebe o Worker que terminou e True se o usuário pediu cancelamento,
+        ou False se terminou normalmente. Em seguida, inicia o próximo job
+        da fila para o mesmo master, se houver.
+        """
+        worker.wait()                               # o sinal sai do fim do run(); espera a thread encerrar
+        self.jobs.pop(worker.master, None)
+        try:
+            self.report_job(worker, canceled)
+        finally:
+            for i, (paths, master) in enumerate(self.job_queue):
+                if master == worker.master:
+                    del self.job_queue[i]
+                    self.start_job(paths, master)
+                    break
+            self.update_job_buttons()
+
+    def report_job(self, worker: Worker, canceled: bool):
+        """
+        Mostra o resumo do job no painel Detalhes e oferece a exportação para o site.
+        """
+        tag = self.job_name(worker.master)
+        if worker.error is not None:
+            self.details_text.append(
+                f"[{tag}] ❌ Processo interrompido por erro: {worker.error}\n"
+                f"- {worker.added} linha(s) já adicionada(s); use 'Restaurar' se precisar voltar."
+            )
+        elif canceled:
+            # o próprio Worker restaura o backup, ainda com o lock do master
+            if worker.restored:
+                self.details_text.append(f"[{tag}] 🚫 Processo cancelado. Backup restaurado.")
+            else:
+                self.details_text.append(f"[{tag}] 🚫 Processo cancelado.")
         else:
             self.details_text.append(
-                f"✔️ Concluído(s) {worker.total} merge(s).\n"
+                f"[{tag}] ✔️ Concluído(s) {worker.total} merge(s).\n"
                 f"- {worker.added} linha(s) adicionada(s).\n"
                 f"- Total final: {worker.total_lines} linha(s)."
             )
@@ -473,58 +781,142 @@ class MainWindow(QMainWindow):
             resposta = QMessageBox.question(
                 self,
                 "Exportar para o site",
-                f"Deseja atualizar o arquivo '{data_name}' no projeto do site?",
+                f"[{tag}] Deseja atualizar o arquivo '{data_name}' no projeto do site?",
                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
                 QMessageBox.StandardButton.Yes
             )
             if resposta == QMessageBox.StandardButton.Yes:
-                df_master   = pd.read_csv(worker.master)
-                op_path     = renob_data / data_name
-                df_master.to_csv(str(op_path), index=False)
-                self.details_text.append("📂 Exportado para o projeto com sucesso!")
+                self.start_export(worker, renob_data / data_name)
 
-
-        # habilita/desabilita botões e oculta barra depois de um tempo
-        self.button_cancel.setEnabled(False)
-        self.button_restore.setEnabled(True)
-        self.button_process.setEnabled(True)
-        self.button_select.setEnabled(True)
-        self.rb_op1.setEnabled(True)
-        self.rb_op2.setEnabled(True)
+    def start_export(self, worker: Worker, op_path: Path):
+        """
+        Exporta, em segundo plano, o master e os agregados do job `worker` para o site.
+        """
+        tag    = self.job_name(worker.master)
+        export = ExportWorker(
+            worker.master,
+            op_path,
+            touched = worker.touched,
+            added   = {worker.master.stem: worker.added}
+        )
+        self.exports[worker.master] = export
+        self.details_text.append(f"[{tag}] - Exportando para o projeto...")
+        export.finished.connect(lambda result, e=export: self.on_export_finished(e, result))
+        export.start()
+
+    def on_export_finished(self, export: ExportWorker, result):
+        export.wait()                               # o sinal sai do fim do run(); espera a thread encerrar
+        if self.exports.get(export.master) is export:
+            del self.exports[export.master]
+        tag = self.job_name(export.master)
+        if isinstance(result, Exception):
+            self.details_text.append(f"[{tag}] ❌ Falha ao exportar para o projeto: {result}")
+            return
+        self.details_text.append(f"[{tag}] 📂 Exportado para o projeto com sucesso!")
+        self.details_text.append(f"[{tag}] 📊 {result} arquivo(s) de agregados atualizado(s).")
 
     
-    def restore_last_backup(self):
+    def short_source(self, source: str, limit: int = 60) -> str:
+        # entradas antigas do catálogo podem ter a lista completa de arquivos
+        return source if len(source) <= limit else source[:limit - 1] + "…"
+
+    def run_backup_task(self, task, on_done):
+        """
+        Roda `task` em um BackupTaskWorker e entrega o resultado a `on_done`.
         """
-        Busca o backup mais recente em BACKUP_DIR e restaura para MASTER_FILE.
+        self.backup_task = BackupTaskWorker(task)
+        self.backup_task.finished.connect(on_done)
+        self.backup_task.start()
+        self.update_job_buttons()
+
+    def restore_from_backup(self):
         """
+        Carrega, em segundo plano, o catálogo de backups do master atual; na primeira
+        vez isso importa os backups antigos (lendo cada arquivo para o sha256).
+        """
+        if self.backup_task and self.backup_task.isRunning():
+            return
+        master = self.get_current_master()
+        self.details_text.append(f"- Carregando os backups de {master.name}...")
+
+        def listar():
+            with file_lock(BACKUP_DIR):
+                return list_backups(master, BACKUP_DIR)         # mais novo → mais antigo
+
+        self.run_backup_task(listar, lambda result: self.on_backups_listed(master, result))
+
+    def on_backups_listed(self, master: Path, backups):
+        """
+        Mostra as versões do catálogo e restaura (em segundo plano) a escolhida.
+        """
+        self.backup_task.wait()                     # o sinal sai do fim do run(); espera a thread encerrar
+        self.update_job_buttons()
+        if isinstance(backups, Exception):
+            QMessageBox.warning(self, "Restaurar", f"Não foi possível listar os backups: {backups}")
+            return
+        if not backups:
+            QMessageBox.information(self, "Restaurar", "Nenhum backup encontrado.")
+            return
+
+        labels = [
+            f"{e['timestamp'].replace('T', ' ')}  ·  {e['rows']} linha(s)  ·  "
+            f"{e['size'] / 1_000_000:.1f} MB" + (f"  ·  {self.short_source(e['source'])}" if e['source'] else "")
+            for e in backups
+        ]
+        escolha, ok = QInputDialog.getItem(
+            self,
+            "Restaurar",
+            f"Versão de {master.name} a restaurar:",
+            labels,
+            0,
+            False
+        )
+        if not ok:
+            return
+        entry = backups[labels.index(escolha)]
+
         resposta = QMessageBox.question(
             self,
             "Confirmar restauração",
-            "Tem certeza que deseja restaurar a Database para a última versão?",
+            f"Tem certeza que deseja restaurar a Database para a versão de {entry['timestamp'].replace('T', ' ')}?",
             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.Cancel,
             QMessageBox.StandardButton.Cancel 
         )
         if resposta != QMessageBox.StandardButton.Yes:
             return
-        
-        # Pattern de nome: master_DDMMYYYYThhmmss.csv
-        master = self.get_current_master()
-        pattern = f"{master.stem}_*{master.suffix}"
-        backups = sorted(
-            BACKUP_DIR.glob(pattern),
-            key=lambda p: p.name
+
+        # troca em tempo constante: só tamanho/mtime do backup são conferidos contra o catálogo
+        self.run_backup_task(
+            lambda: restore_version(master, BACKUP_DIR, entry["version"], timeout=0),
+            lambda result: self.on_backup_restored(master, result)
         )
-        if not backups:
+
+    def on_backup_restored(self, master: Path, restored):
+        self.backup_task.wait()
+        self.update_job_buttons()
+        if isinstance(restored, TimeoutError):
+            QMessageBox.warning(self, "Restaurar", f"Não foi possível restaurar agora: {restored}")
+            return
+        if isinstance(restored, OSError):
+            QMessageBox.warning(
+                self,
+                "Restaurar",
+                f"Não foi possível substituir {master.name} (o arquivo está aberto em outro programa?):\n{restored}"
+            )
+            return
+        if isinstance(restored, Exception):
+            QMessageBox.warning(self, "Restaurar", f"Não foi possível restaurar: {restored}")
+            return
+        if restored is None:
             QMessageBox.information(self, "Restaurar", "Nenhum backup encontrado.")
             return
-
-        latest = backups[-1]
-        shutil.copy2(latest, master)
         QMessageBox.information(
             self,
             "Restaurar",
-            f"Backup restaurado ({master.name}): {latest.name}"
+            f"Backup restaurado ({master.name}): {restored['file']}"
         )
         # opcional: atualizar UI
-        self.progress.setValue(0)
-        self.details_text.append(f"{master.name} restaurado para: {latest.name}")
\ No newline at end of file
+        self.progress_bars[master].setValue(0)
+        self.details_text.append(
+            f"{master.name} restaurado para: {restored['file']} ({restored['rows']} linha(s))"
+        )
\ No newline at end of file
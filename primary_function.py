@@ -1,26 +1,110 @@
 import pandas as pd
+import numpy as np
 import hashlib
+import csv
+import json
+import math
+import os
+import re
+import shutil
 from pathlib import Path
-from storage import load_config
+from storage import load_config, file_lock, io_lock, write_master_meta, restore_backup
 from typing  import Optional
 
+# pyarrow é opcional: se estiver instalado, a leitura dos CSVs é multithread e
+# mapeada em memória; caso contrário, cai no pd.read_csv tradicional.
+try:
+    import pyarrow      as pa
+    import pyarrow.csv  as pa_csv
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    pa          = None
+    pa_csv      = None
+    CSV_ENGINE  = "pandas"
+
 #==============================================================================#
 #======================= HASH PARA COMPARAÇÂO =================================#
 #==============================================================================#
 def hash_line(line: str) -> str:
     return hashlib.sha256(line.encode('utf-8')).hexdigest()
 
+def row_hashes(df: pd.DataFrame) -> list:
+    """
+    Hash de cada linha do DataFrame (linha inteira como string), como no merge.
+    """
+    if df.empty:
+        return []
+    return df.apply(lambda row: hash_line(','.join(map(str, row.tolist()))), axis=1).tolist()
+
 #==============================================================================#
-#======================= CARREGA/CRIA AS DBS ==================================#
+#======================= LEITURA DOS CSVs =====================================#
 #==============================================================================#
-def load_create_master(master_path: Path) -> pd.DataFrame:
+def read_header(path: Path) -> list:
+    """
+    Retorna a lista de colunas (primeira linha) do CSV, sem ler o resto do arquivo.
+    """
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        return next(csv.reader(f), [])
+
+def read_csv(path: Path, usecols: Optional[list] = None) -> pd.DataFrame:
+    """
+    Lê um CSV com o motor disponível (CSV_ENGINE).
+    Se `usecols` for informado, só as colunas dessa lista que existem no arquivo
+    são decodificadas (na ordem do arquivo); as demais são descartadas já no parse.
+    """
+    if usecols is not None:
+        wanted  = set(usecols)
+        usecols = [col for col in read_header(path) if col in wanted]
+        if not usecols:                                 # pyarrow leria TODAS as colunas com lista vazia
+            return pd.DataFrame()
+
+    if pa_csv is None:
+        return pd.read_csv(path, usecols=usecols)
+
+    read_opts    = pa_csv.ReadOptions(use_threads=True)
+    convert_opts = pa_csv.ConvertOptions(
+        include_columns     = usecols,
+        strings_can_be_null = True,                     # vazios em colunas de texto viram nulos
+    )
+    with pa.memory_map(str(path), "r") as source:
+        table = pa_csv.read_csv(source, read_options=read_opts, convert_options=convert_opts)
+    df = table.to_pandas()
+
+    # Os vazios precisam sair iguais aos do pd.read_csv, senão o hash das linhas
+    # muda ("None" x "nan") e o merge duplica linhas que já estão no master:
+    #  - coluna toda vazia (tipo null no Arrow) → float64 NaN, como no pandas
+    #  - nulos em colunas object (texto, bool) → NaN em vez de None
+    for name, tipo in zip(table.column_names, table.schema.types):
+        if pa.types.is_null(tipo):
+            df[name] = df[name].astype("float64")
+        elif df[name].dtype == object:
+            df[name] = df[name].where(df[name].notna(), float("nan"))
+    return df
+
+def master_columns(master_path: Path) -> list:
+    """
+    Colunas permitidas para o master (Sisvan ou Regional), conforme o config.json.
+    """
     cfg = load_config()
+    if 'sisvan' in master_path.stem:
+        return cfg["colunasSisvan"]
+    return cfg["colunasRegional"]
+
+#==============================================================================#
+#======================= CARREGA/CRIA AS DBS ==================================#
+#==============================================================================#
+def load_create_master(master_path: Path, project: bool = False) -> pd.DataFrame:
+    """
+    Carrega o master (ou um DataFrame vazio com as colunas do config.json).
+    Por padrão lê TODAS as colunas: o merge regrava o master a partir deste
+    DataFrame, e colunas extras não podem se perder. `project=True` lê só as
+    colunas do config.json, para consumidores que não gravam (agregados).
+    """
+    colunas = master_columns(master_path)
     if master_path.exists():
-        return pd.read_csv(master_path)
-    elif 'sisvan' in master_path.stem:
-        return pd.DataFrame(columns=cfg["colunasSisvan"])
-    else: 
-        return pd.DataFrame(columns=cfg["colunasRegional"])
+        with io_lock(master_path):                      # não deixa o master ser trocado no meio da leitura
+            return read_csv(master_path, usecols=colunas if project else None)
+    return pd.DataFrame(columns=colunas)
 
 #==============================================================================#
 #======================= TRATAMENTO DOS DADOS =================================#
@@ -31,10 +115,7 @@ def treatment(new_csv: Path, master_csv: Path):
     if 'sisvan' in master_csv.stem:
         colunas = cfg["colunasSisvan"]
 
-        new_df = pd.read_csv(new_csv)
-
-        matching_columns = [col for col in new_df.columns if col in colunas]
-        new_df = new_df[matching_columns]
+        new_df = read_csv(new_csv, usecols=colunas)    # só as colunas permitidas são lidas
 
         for col in colunas:
             if col not in new_df.columns:
@@ -54,10 +135,7 @@ def treatment(new_csv: Path, master_csv: Path):
     elif 'regional' in master_csv.stem:
         colunas = cfg["colunasRegional"]
 
-        new_df = pd.read_csv(new_csv)
-
-        matching_columns = [col for col in new_df.columns if col in colunas]
-        new_df = new_df[matching_columns]
+        new_df = read_csv(new_csv, usecols=colunas)
 
         return new_df
 
@@ -77,12 +155,179 @@ def find_renob(target: str, start: Optional[Path]=None):
             if p.is_dir():
                 return p
     return None
+
+#==============================================================================#
+#==================== AGREGADOS PARA O SITE ===================================#
+#==============================================================================#
+AGG_KEYS        = ["UF", "ANO", "fase_vida", "SEXO"]
+REGIONAL_KEYS   = ["estado_abrev", "regional_id", "regional_nome"]
+AGG_MANIFEST    = "index.json"
+AGG_FLOAT_FMT   = "%.15g"                           # 4.0 → "4", 4.5 → "4.5", igual em qualquer export
+SHARD_UNKNOWN   = "desconhecido"                    # ANO/UF ausente ou inválido
+
+def agg_measures() -> list:
+    """
+    Colunas numéricas do Sisvan que são somadas nos agregados.
+    """
+    cfg     = load_config()
+    ignorar = AGG_KEYS + ["codigo_municipio", "municipio"]
+    return [col for col in cfg["colunasSisvan"] if col not in ignorar]
+
+def _municipio_id(serie: pd.Series) -> pd.Series:
+    # normaliza o código do município (int, float ou texto) para o join
+    return pd.to_numeric(serie, errors="coerce").astype("Int64").astype(str)
+
+def _shard_part(value) -> str:
+    # parte do nome do shard: só caracteres válidos em nomes de arquivo no Windows
+    if pd.isna(value):
+        return SHARD_UNKNOWN
+    safe = re.sub(r"[^0-9A-Za-z-]+", "_", str(value).strip()).strip("_")
+    return safe or SHARD_UNKNOWN
+
+def _shard_ano(value: float) -> str:
+    return str(int(value)) if math.isfinite(value) else SHARD_UNKNOWN
+
+def _shard_keys(df: pd.DataFrame) -> pd.Series:
+    # nome do shard de cada linha: "{ANO}_{UF}", ex: "2023_PE"; ausentes → "desconhecido".
+    # O nome é montado uma vez por par (ANO, UF) distinto e espalhado pelas linhas via códigos.
+    anos = pd.to_numeric(df["ANO"], errors="coerce").astype("float64")
+    ano_codes, ano_valores = pd.factorize(anos)
+    uf_codes,  uf_valores  = pd.factorize(df["UF"])
+
+    # código -1 (valor ausente) aponta para o último item: "desconhecido"
+    ano_nomes = [_shard_ano(a) for a in ano_valores] + [SHARD_UNKNOWN]
+    uf_nomes  = [_shard_part(u) for u in uf_valores] + [SHARD_UNKNOWN]
+    ano_idx   = np.where(ano_codes < 0, len(ano_nomes) - 1, ano_codes)
+    uf_idx    = np.where(uf_codes < 0, len(uf_nomes) - 1, uf_codes)
+
+    par_codes, pares = pd.factorize(ano_idx * len(uf_nomes) + uf_idx)
+    nomes = np.array(
+        [f"{ano_nomes[p // len(uf_nomes)]}_{uf_nomes[p % len(uf_nomes)]}" for p in pares],
+        dtype=object
+    )
+    return pd.Series(nomes[par_codes], index=df.index, dtype=object)
+
+def touched_shards(added_df: pd.DataFrame, master_path: Path) -> set:
+    """
+    Retorna os shards (ANO_UF) do site afetados pelas linhas recém-adicionadas ao master.
+    No Regional, são os shards dos municípios do Sisvan que ganharam (nova) regional.
+    """
+    if added_df.empty:
+        return set()
+    if 'sisvan' in master_path.stem:
+        return set(_shard_keys(added_df))
+
+    cfg = load_config()
+    if not cfg["sisvan_path"].exists() or "municipio_id_sdv" not in added_df.columns:
+        return set()
+    with io_lock(cfg["sisvan_path"]):                   # o job do Sisvan pode estar trocando o arquivo
+        sisvan_df = read_csv(cfg["sisvan_path"], usecols=["codigo_municipio", "ANO", "UF"])
+    ids       = set(_municipio_id(added_df["municipio_id_sdv"]))
+    afetados  = sisvan_df[_municipio_id(sisvan_df["codigo_municipio"]).isin(ids)]
+    return set(_shard_keys(afetados))
+
+def _aggregate_totais(sisvan_df: pd.DataFrame, medidas: list) -> pd.DataFrame:
+    return sisvan_df.groupby(AGG_KEYS + ["_shard"], as_index=False, dropna=False)[medidas].sum()
+
+def _aggregate_regional(sisvan_df: pd.DataFrame, regional_df: pd.DataFrame, medidas: list) -> pd.DataFrame:
+    regional = (
+        regional_df[REGIONAL_KEYS]
+        .assign(_mun=_municipio_id(regional_df["municipio_id_sdv"]))
+        .drop_duplicates()
+    )
+    joined = (
+        sisvan_df
+        .assign(_mun=_municipio_id(sisvan_df["codigo_municipio"]))
+        .merge(regional, on="_mun", how="inner")
+    )
+    return joined.groupby(REGIONAL_KEYS + AGG_KEYS + ["_shard"], as_index=False, dropna=False)[medidas].sum()
+
+def export_aggregates(out_dir: Path, touched: Optional[set] = None, added: Optional[dict] = None) -> int:
+    """
+    Gera em `out_dir` os agregados usados pelo site, em shards por ANO/UF:
+      - totais/{ANO}_{UF}.csv   → somas por UF/ANO/fase_vida/SEXO
+      - regional/{ANO}_{UF}.csv → somas por regional (codigo_municipio × municipio_id_sdv)
+    Só os shards em `touched` são recalculados, desde que o index.json confirme que os
+    agregados atuais foram gerados a partir dos masters de antes do merge (`added` traz
+    as linhas adicionadas por master); caso contrário, tudo é reconstruído.
+    Retorna o número de shards escritos.
+    """
+    cfg         = load_config()
+    sisvan_df   = load_create_master(cfg["sisvan_path"], project=True)
+    regional_df = load_create_master(cfg["regional_path"], project=True)
+    rows = {
+        cfg["sisvan_path"].stem:   len(sisvan_df),
+        cfg["regional_path"].stem: len(regional_df),
+    }
+
+    manifest_path = out_dir / AGG_MANIFEST
+    manifest      = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    built_rows  = manifest.get("rows", {})
+    added       = added or {}
+    incremental = touched is not None and all(
+        stem in built_rows and built_rows[stem] + added.get(stem, 0) == n
+        for stem, n in rows.items()
+    )
+
+    medidas   = agg_measures()
+    sisvan_df = sisvan_df.assign(_shard=_shard_keys(sisvan_df))
+    if incremental:
+        sisvan_df = sisvan_df[sisvan_df["_shard"].isin(touched)].copy()
+    else:
+        for sub in ("totais", "regional"):
+            shutil.rmtree(out_dir / sub, ignore_errors=True)
+    # float64 fixo: com ou sem NaN no master, os shards saem com o mesmo formato numérico
+    sisvan_df[medidas] = (
+        sisvan_df[medidas].apply(pd.to_numeric, errors="coerce").fillna(0).astype("float64")
+    )
+
+    outputs = {
+        "totais":   _aggregate_totais(sisvan_df, medidas),
+        "regional": _aggregate_regional(sisvan_df, regional_df, medidas),
+    }
+    written = 0
+    for sub, agg in outputs.items():
+        (out_dir / sub).mkdir(parents=True, exist_ok=True)
+        for shard, part in agg.groupby("_shard"):
+            part.drop(columns="_shard").to_csv(
+                out_dir / sub / f"{shard}.csv", index=False, float_format=AGG_FLOAT_FMT
+            )
+            written += 1
+
+    # index.json: lista de shards disponíveis + linhas dos masters usadas na geração
+    manifest = {"rows": rows}
+    for sub in outputs:
+        manifest[sub] = sorted(p.stem for p in (out_dir / sub).glob("*.csv"))
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    return written
    
 
 #==============================================================================#
 #===================== FUNÇÃO PRINCIPAL DE MERGE ==============================#
 #==============================================================================#
 def merge_csvs(new_csv: pd.DataFrame, master_path:Path) -> dict:
+    # lock do master entre processos: outra instância (ou script) espera este merge terminar
+    with file_lock(master_path):
+        return _merge_locked(new_csv, master_path)
+
+def write_master(df: pd.DataFrame, master_path: Path) -> None:
+    """
+    Grava o master de forma atômica (arquivo temporário + os.replace),
+    para que leitores nunca vejam um CSV escrito pela metade. A troca espera
+    (io_lock) os leitores do app soltarem o arquivo, exigência do Windows.
+    Atualiza junto o .meta.json com o número de linhas.
+    """
+    tmp_path = master_path.with_name(master_path.name + ".tmp")
+    df.to_csv(tmp_path, index=False)
+    with io_lock(master_path):
+        os.replace(tmp_path, master_path)
+    write_master_meta(master_path, len(df))
+
+def _merge_locked(new_csv: pd.DataFrame, master_path:Path) -> dict:
     
     master_df   = load_create_master(master_path)         # carrega o Master.csv
     new_df      = new_csv.copy()                                 # Leitura do arquivo .csv selecionado
@@ -96,10 +341,7 @@ def merge_csvs(new_csv: pd.DataFrame, master_path:Path) -> dict:
         # se master está vazio, podemos criar com as mesmas colunas
         new_df = new_df.reindex(columns=new_df.columns, fill_value='')
     
-    existing_hashes = set(
-        master_df
-        .apply(lambda row: hash_line(','.join(map(str, row.tolist()))), axis=1)
-    ) if not master_df.empty else set()
+    existing_hashes = set(row_hashes(master_df))
 
     #itera sobre cada linha de new_df: string única -> hash -> compara 
     added = []
@@ -117,10 +359,101 @@ def merge_csvs(new_csv: pd.DataFrame, master_path:Path) -> dict:
             updated = added_df
         else:
             updated = pd.concat([master_df,added_df], ignore_index=True)
-        updated.to_csv(master_path, index=False)
+        write_master(updated, master_path)
     else:
+        added_df = pd.DataFrame(columns=new_df.columns)
         updated = master_df
     return{                                             # retorna dicionario com resumo do resultado 
         "added_count": len(added),                      # do processo: quantas linhas adicionadas e 
-        "total_after": len(updated)                     # o novo total de linhas
-    }
\ No newline at end of file
+        "total_after": len(updated),                    # o novo total de linhas
+        "added_rows":  added_df                         # as próprias linhas (p/ agregados do site)
+    }
+
+#==============================================================================#
+#===================== PRÉVIA DO MERGE (DRY-RUN) ==============================#
+#==============================================================================#
+_master_state_cache: dict = {}
+
+def master_hashes(master_path: Path) -> tuple:
+    """
+    Estado de deduplicação do master, somente leitura: (colunas, hashes).
+    `colunas` é None se o master ainda não existe/está vazio.
+    Fica em cache enquanto o arquivo não muda (mtime/tamanho).
+    """
+    if not master_path.exists():
+        return None, frozenset()
+
+    stat   = master_path.stat()
+    key    = (stat.st_mtime_ns, stat.st_size)
+    cached = _master_state_cache.get(master_path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    master_df = load_create_master(master_path)
+    columns   = list(master_df.columns) if not master_df.empty else None
+    state     = (columns, frozenset(row_hashes(master_df)))
+    _master_state_cache[master_path] = (key, state)
+    return state
+
+def preview_merge(paths: list, master_path: Path, sample_size: int = 5) -> list:
+    """
+    Simula o merge de `paths` no master, na mesma ordem do Worker, sem gravar nada
+    (nem master, nem backup, nem log). Retorna um dict por arquivo com:
+      - input_file, rows
+      - new_count:             linhas que seriam adicionadas
+      - duplicate_count:       linhas que já existem no master
+      - batch_duplicate_count: linhas repetidas dentro do próprio lote
+      - sample:                DataFrame com até `sample_size` linhas novas
+    """
+    columns, existing = master_hashes(master_path)
+    seen    = set()                                     # hashes novos já vistos no lote
+    results = []
+
+    for path in paths:
+        new_df = treatment(Path(path), master_path)
+        if columns is not None:
+            new_df = new_df.reindex(columns=columns, fill_value='')
+
+        is_new = []
+        duplicates = batch_duplicates = 0
+        for h in row_hashes(new_df):
+            if h in existing:
+                duplicates += 1
+                is_new.append(False)
+            elif h in seen:
+                batch_duplicates += 1
+                is_new.append(False)
+            else:
+                seen.add(h)
+                is_new.append(True)
+
+        new_rows = new_df.loc[pd.Series(is_new, index=new_df.index, dtype=bool)]
+        if columns is None and not new_rows.empty:      # 1º arquivo com linhas novas cria o master
+            columns = list(new_df.columns)
+
+        results.append({
+            "input_file":            str(path),
+            "rows":                  len(new_df),
+            "new_count":             len(new_rows),
+            "duplicate_count":       duplicates,
+            "batch_duplicate_count": batch_duplicates,
+            "sample":                new_rows.head(sample_size),
+        })
+    return results
+
+#==============================================================================#
+#===================== RESTAURAÇÃO DE BACKUP ==================================#
+#==============================================================================#
+def restore_version(master_path: Path, backup_dir: Path, version: Optional[str] = None,
+                    verify: bool = False, timeout: Optional[float] = None) -> Optional[dict]:
+    """
+    Restaura uma versão do catálogo de backups (a mais recente se `version` for None)
+    e atualiza junto os artefatos derivados do master: o .meta.json (contagem de
+    linhas) é regravado por restore_backup e o índice de deduplicação em cache é
+    descartado. Tamanho e mtime do backup são sempre conferidos; `verify=True`
+    confere também o sha256 (lê o arquivo inteiro).
+    Retorna a entrada do catálogo restaurada, ou None sem backups.
+    """
+    entry = restore_backup(master_path, backup_dir, version, verify=verify, timeout=timeout)
+    _master_state_cache.pop(master_path, None)
+    return entry
\ No newline at end of file
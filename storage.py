@@ -1,5 +1,15 @@
-import json, os, sys, datetime, shutil
-from pathlib import Path
+import json, os, sys, datetime, shutil, time, threading, hashlib
+from pathlib     import Path
+from contextlib  import contextmanager
+from typing      import Optional, Callable
+
+# lock entre processos: msvcrt no Windows (onde o .exe roda), fcntl nos demais
+try:
+    import msvcrt
+    fcntl = None
+except ImportError:
+    msvcrt = None
+    import fcntl
 
 def resource_path(relative_path: str) -> str:
     """
@@ -47,46 +57,327 @@ def count_lines(path:Path, has_header:bool=True) -> int :
                 total = sum(1 for _ in f)
             return total - 1 if has_header else total
 
+#=====================================================================================#
+#================================ MASTER META SECTION ================================#
+#=====================================================================================#
+# Contagem de linhas do master guardada em '<master>.meta.json', válida enquanto
+# tamanho e mtime do arquivo forem os mesmos (evita recontar o CSV a cada job).
+def master_meta_path(master: Path) -> Path:
+    return master.with_name(master.name + ".meta.json")
+
+def write_master_meta(master: Path, rows: int):
+    """
+    Registra o número de linhas do master no estado atual do arquivo.
+    Deve ser chamada sempre que o master é substituído (merge ou restauração).
+    """
+    st = master.stat()
+    meta = {"rows": rows, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    with open(master_meta_path(master), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+def master_rows(master: Path) -> int:
+    """
+    Número de linhas (sem cabeçalho) do master, lido do .meta.json quando ainda
+    corresponde ao arquivo; senão conta as linhas e atualiza o .meta.json.
+    """
+    if not master.exists():
+        return 0
+    meta_path = master_meta_path(master)
+    st = master.stat()
+    if meta_path.exists():
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["size"] == st.st_size and meta["mtime_ns"] == st.st_mtime_ns:
+                return meta["rows"]
+        except (ValueError, KeyError):
+            pass                                        # meta corrompido: recalcula
+    rows = count_lines(master)
+    write_master_meta(master, rows)
+    return rows
+
+#=====================================================================================#
+#================================== LOCK SECTION =====================================#
+#=====================================================================================#
+_held_locks: dict = {}                  # lock_path -> [thread_id, contagem, arquivo aberto]
+_held_guard = threading.Lock()
+
+def lock_path_for(target: Path) -> Path:
+    """
+    Arquivo de lock de `target`: '<pasta>/.lock' para pastas, '<arquivo>.lock' para arquivos.
+    """
+    if target.is_dir():
+        return target / ".lock"
+    return target.with_name(target.name + ".lock")
+
+def _try_lock(f) -> None:
+    # levanta OSError se outro processo/handle já tiver o lock
+    if msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def _unlock(f) -> None:
+    if msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def file_lock(target: Path, timeout: Optional[float] = None, poll: float = 0.2,
+              on_wait: Optional[Callable[[], None]] = None):
+    """
+    Lock exclusivo de `target` (master ou pasta de backup), válido entre processos
+    e entre threads. É reentrante na mesma thread: o Worker segura o lock do master
+    durante todo o processamento e o merge_csvs pode pedi-lo de novo.
+    Com `timeout` (segundos), levanta TimeoutError se não conseguir o lock a tempo.
+    `on_wait` é chamado uma vez, se for preciso esperar outra execução liberar o lock.
+    """
+    lock_path = lock_path_for(target)
+    me        = threading.get_ident()
+
+    with _held_guard:
+        held = _held_locks.get(lock_path)
+        if held and held[0] == me:
+            held[1] += 1
+            reentrant = True
+        else:
+            reentrant = False
+    if reentrant:
+        try:
+            yield
+        finally:
+            with _held_guard:
+                _held_locks[lock_path][1] -= 1
+        return
+
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    f     = open(lock_path, "a+")
+    start = time.monotonic()
+    waited = False
+    try:
+        while True:
+            try:
+                _try_lock(f)
+                break
+            except OSError:
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    raise TimeoutError(f"{target} está em uso por outra execução.")
+                if on_wait is not None and not waited:
+                    on_wait()
+                waited = True
+                time.sleep(poll)
+
+        with _held_guard:
+            _held_locks[lock_path] = [me, 1, f]
+        try:
+            yield
+        finally:
+            with _held_guard:
+                del _held_locks[lock_path]
+            _unlock(f)
+    finally:
+        f.close()
+
+def io_lock(master: Path, timeout: Optional[float] = None):
+    """
+    Lock curto de E/S do master, separado do file_lock(master) que o Worker segura
+    pelo job inteiro: leitores o seguram só durante a leitura e quem substitui o
+    arquivo, só durante o os.replace. No Windows o os.replace falha (PermissionError)
+    se houver outro handle aberto no arquivo.
+    """
+    return file_lock(master.with_name(master.name + ".io"), timeout=timeout)
+
 #=====================================================================================#
 #================================= BACKUP SECTION ====================================#
 #=====================================================================================#
+# Catálogo dos backups em '<backup_dir>/backup_catalog.json', uma lista de versões por master:
+# { "db_sisvan.csv": [ {version, file, timestamp, rows, size, sha256, source}, ... ] }
+CATALOG_FILE = "backup_catalog.json"
+
+def file_stats(path: Path, has_header: bool = True) -> tuple:
+    """
+    Lê o arquivo uma vez (em blocos) e retorna (linhas, sha256).
+    """
+    digest = hashlib.sha256()
+    lines  = 0
+    last   = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+            lines += chunk.count(b"\n")
+            last   = chunk[-1:]
+    if last and last != b"\n":                         # última linha sem quebra de linha
+        lines += 1
+    if has_header and lines:
+        lines -= 1
+    return lines, digest.hexdigest()
+
+def _load_catalog(backup_dir: Path) -> dict:
+    path = backup_dir / CATALOG_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_catalog(backup_dir: Path, catalog: dict):
+    # grava em arquivo temporário e troca, para o catálogo nunca ficar pela metade
+    path = backup_dir / CATALOG_FILE
+    tmp  = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+def _catalog_entry(backup_file: Path, timestamp: str, source: str) -> dict:
+    rows, sha = file_stats(backup_file)
+    st = backup_file.stat()
+    return {
+        "version":   backup_file.stem,                  # ex: db_sisvan_05082025-152300
+        "file":      backup_file.name,
+        "timestamp": timestamp,
+        "rows":      rows,
+        "size":      st.st_size,
+        "mtime_ns":  st.st_mtime_ns,
+        "sha256":    sha,
+        "source":    source,
+    }
+
+def list_backups(original: Path, backup_dir: Path) -> list:
+    """
+    Versões de backup do `original` registradas no catálogo, da mais nova para a mais antiga.
+    Na primeira vez para um master, importa os backups que já existiam na pasta
+    (gerados antes do catálogo). Deve ser chamada com o lock de `backup_dir`.
+    """
+    catalog = _load_catalog(backup_dir)
+    changed = False
+    if original.name not in catalog:
+        # Padrão de nome: {stem}_{timestamp}{suffix}, ex: master_20250805T152300.csv
+        legacy = []
+        for p in backup_dir.glob(f"{original.stem}_*{original.suffix}"):
+            mtime = datetime.datetime.fromtimestamp(p.stat().st_mtime)
+            legacy.append(_catalog_entry(p, mtime.isoformat(timespec="seconds"), ""))
+        catalog[original.name] = legacy
+        changed = True
+
+    entries = [e for e in catalog[original.name] if (backup_dir / e["file"]).exists()]
+    if len(entries) != len(catalog[original.name]):     # backups apagados fora do app
+        catalog[original.name] = entries
+        changed = True
+    if changed:
+        _save_catalog(backup_dir, catalog)
+    # empate no timestamp (mesmo segundo): vale a ordem de inserção no catálogo
+    ordered = sorted(enumerate(entries), key=lambda ie: (ie[1]["timestamp"], ie[0]), reverse=True)
+    return [e for _, e in ordered]
+
 def rotate_backup(original:Path, backup_dir:Path, keep: int=3, suffix: str = ".csv"):
     """
     Garante que não haja mais de `keep` arquivos de backup para o mesmo original.
     - original: Path do arquivo que estamos versionando (ex: master.csv)
     - backup_dir: Path da pasta de backups
     - keep: número máximo de arquivos a manter
-    - suffix: extensão dos backups (padrão '.csv')
+    - suffix: mantido por compatibilidade; o catálogo já registra o nome de cada backup
     """
-    stem = original.stem
-    # Padrão de nome: {stem}_{timestamp}{suffix}, ex: master_20250805T152300.csv
-    pattern = f"{stem}_*{suffix}"
-    backups = sorted(backup_dir.glob(pattern),key=lambda p: p.name)      # ordena alfabeticamente, e timestamps ISO sortam cronologicamente
-        
+    with file_lock(backup_dir):
+        backups = list_backups(original, backup_dir)    # mais novo → mais antigo
 
-    # Se já há >= keep cópias, remove as mais antigas até sobrar (keep-1)
-    while len(backups) >= keep:
-        oldest = backups.pop(0)     # retira e obtém o primeiro (mais antigo)
-        try:
-             oldest.unlink()
-        except Exception as e:
-             print(f"Falha ao remover backup antigo {oldest}: {e}")
+        # Se já há >= keep cópias, remove as mais antigas até sobrar (keep-1)
+        removed = set()
+        while len(backups) >= keep:
+            oldest = backups.pop()      # retira e obtém o último (mais antigo)
+            try:
+                 (backup_dir / oldest["file"]).unlink()
+                 removed.add(oldest["version"])
+            except Exception as e:
+                 print(f"Falha ao remover backup antigo {oldest['file']}: {e}")
+
+        if removed:
+            catalog = _load_catalog(backup_dir)
+            catalog[original.name] = [e for e in catalog[original.name] if e["version"] not in removed]
+            _save_catalog(backup_dir, catalog)
+
+def describe_sources(paths: list, show: int = 2) -> str:
+    """
+    Resumo curto dos arquivos de um merge para o catálogo, ex: "3 arquivo(s): a.csv, b.csv, …".
+    """
+    names = [Path(p).name for p in paths]
+    resumo = ", ".join(names[:show]) + (", …" if len(names) > show else "")
+    return f"{len(names)} arquivo(s): {resumo}"
 
-def backup(original:Path, backup_dir: Path, date_format: str = "%d%m%Y-%H%M%S"):
+def backup(original:Path, backup_dir: Path, date_format: str = "%d%m%Y-%H%M%S", source: str = "") -> dict:
     """
-    Gera um backup do `original` em `backup_dir`, mantendo o histórico limitado por rotate_backups.
+    Gera um backup do `original` em `backup_dir`, mantendo o histórico limitado por rotate_backups,
+    e registra a versão no catálogo (linhas, tamanho, sha256 e `source`, o merge que a originou).
+    Retorna a entrada do catálogo.
     """
     backup_dir.mkdir(parents=True, exist_ok=True)
-    # faz a rotação antes de criar o novo
-    rotate_backup(original, backup_dir, keep=3, suffix=original.suffix)
+    with file_lock(backup_dir):
+        # faz a rotação antes de criar o novo
+        rotate_backup(original, backup_dir, keep=3, suffix=original.suffix)
 
-    # cria nome com timestamp
-    ts = datetime.datetime.now().strftime(date_format)
-    backup_name = backup_dir / f"{original.stem}_{ts}{original.suffix}"
+        # cria nome com timestamp
+        now = datetime.datetime.now()
+        ts = now.strftime(date_format)
+        backup_name = backup_dir / f"{original.stem}_{ts}{original.suffix}"
 
-    # copia
-    shutil.copy2(original, backup_name)
-    return backup_name
+        # copia
+        with io_lock(original):
+            shutil.copy2(original, backup_name)
+
+        entry   = _catalog_entry(backup_name, now.isoformat(timespec="seconds"), source)
+        catalog = _load_catalog(backup_dir)
+        catalog[original.name] = [
+            e for e in catalog.get(original.name, []) if e["version"] != entry["version"]
+        ] + [entry]
+        _save_catalog(backup_dir, catalog)
+    return entry
+
+def restore_backup(original: Path, backup_dir: Path, version: Optional[str] = None,
+                   verify: bool = False, timeout: Optional[float] = None) -> Optional[dict]:
+    """
+    Restaura a versão `version` do catálogo (a mais recente se None) sobre o `original`.
+    A troca é atômica: o backup vira o master via hardlink + os.replace (tempo constante,
+    sem copiar o CSV); se o sistema de arquivos não suportar hardlink, copia para um
+    temporário antes do os.replace. O .meta.json do master é atualizado junto.
+    Antes da troca, confere tamanho e mtime do backup contra o catálogo (só um stat);
+    `verify=True` confere também o sha256, lendo o arquivo inteiro. Retorna a entrada restaurada,
+    ou None se não houver backups; levanta ValueError se a versão não existir.
+    """
+    with file_lock(original, timeout=timeout), file_lock(backup_dir, timeout=timeout):
+        entries = list_backups(original, backup_dir)
+        if not entries:
+            return None
+        if version is None:
+            entry = entries[0]
+        else:
+            entry = next((e for e in entries if e["version"] == version), None)
+            if entry is None:
+                raise ValueError(f"Versão de backup não encontrada: {version}")
+
+        src = backup_dir / entry["file"]
+        st  = src.stat()
+        if st.st_size != entry["size"] or entry.get("mtime_ns", st.st_mtime_ns) != st.st_mtime_ns:
+            raise ValueError(f"O backup {entry['file']} foi alterado desde que entrou no catálogo")
+        if verify and file_stats(src)[1] != entry["sha256"]:
+            raise ValueError(f"Checksum não confere para o backup {entry['file']}")
+
+        # o master só é substituído via os.replace, nunca editado no lugar,
+        # então compartilhar o arquivo com o backup não altera o backup
+        tmp = original.with_name(original.name + ".tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copy2(src, tmp)
+            with io_lock(original):
+                os.replace(tmp, original)   # PermissionError no Windows se o master estiver aberto (ex: Excel)
+        except BaseException:
+            tmp.unlink(missing_ok=True)     # não deixa o temporário para trás
+            raise
+        write_master_meta(original, entry["rows"])
+    return entry
 
 
 #=====================================================================================#
@@ -111,8 +402,9 @@ def log_merge_file(input_file:str, master_file:str, added_count:int, total_after
         """
         Grava uma linha no CSV de histórico
         """
-        init_log()
         timestamp = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
         line = f'{timestamp},"{input_file}","{master_file}", {added_count}, {total_after}\n'
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(line)
+        with file_lock(LOG_FILE.parent):                # o log fica na pasta de backup
+            init_log()
+            with open(LOG_FILE, "a", encoding="utf-8") as f:
+                f.write(line)